@@ -4,9 +4,13 @@ from datetime import date as _date
 
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+from settlement import split_participants, compute_net, build_settlement_matrix
+
 
 # ============ 1) Auth (Plan B: st.secrets -> fallback local JSON) ============
 scope = [
@@ -23,19 +27,40 @@ def load_sa_credentials():
     with open(json_path, "r") as f:
         return json.load(f)
 
-sa_dict = load_sa_credentials()
-creds = ServiceAccountCredentials.from_json_keyfile_dict(sa_dict, scope)
-client = gspread.authorize(creds)
+# ============ 2) Open Sheets (cached: auth + handles survive reruns) ============
+@st.cache_resource(show_spinner=False)
+def get_sheets():
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(load_sa_credentials(), scope)
+    client = gspread.authorize(creds)
+    book = client.open("Trip Expenses")      # change if needed
+    sheet = book.worksheet("Expenses")       # A:F = Date,Desc,Amount,Payer,Participants,Currency
+    participants_sheet = book.worksheet("Participants")
+    return book, sheet, participants_sheet
 
-# ============ 2) Open Sheets ============
-book = client.open("Trip Expenses")          # change if needed
-sheet = book.worksheet("Expenses")           # A:F = Date,Desc,Amount,Payer,Participants,Currency
-participants_sheet = book.worksheet("Participants")
+book, sheet, participants_sheet = get_sheets()
 
 st.title("🚗 Trip Expense Tracker")
 
+# ============ 2b) Cached reads (cleared explicitly after writes) ============
+@st.cache_data(ttl=60, show_spinner=False)
+def load_sheet_data():
+    """Fetch both sheets in one values.batchGet round-trip: (names, expense values)."""
+    ranges = book.values_batch_get(["Participants!A:A", "Expenses!A:F"]).get("valueRanges", [])
+    name_rows = ranges[0].get("values", []) if ranges else []
+    values = ranges[1].get("values", []) if len(ranges) > 1 else []
+    names = [r[0] for r in name_rows[1:] if r]  # skip header
+    # the API drops trailing empty cells, so pad rows to the header width
+    width = len(values[0]) if values else 0
+    values = [row + [""] * (width - len(row)) for row in values]
+    return names, values
+
 # ============ 3) Settings & constants ============
 currency_options = ["USD", "EUR", "TWD"]
+currency_code = {c: i for i, c in enumerate(currency_options)}
+
+def fx_rate_vector(fx_rates: dict) -> np.ndarray:
+    """Rates as float32 aligned with currency_options; unset/zero -> NaN."""
+    return np.array([float(fx_rates.get(c) or "nan") for c in currency_options], dtype=np.float32)
 
 # session state defaults (tab-specific selectors)
 if "tab_selected_currency" not in st.session_state:
@@ -44,21 +69,73 @@ if "fx_base" not in st.session_state:
     st.session_state.fx_base = currency_options[0]                # for "Converted" tab
 if "fx_rates" not in st.session_state:
     st.session_state.fx_rates = {c: (1.0 if c == st.session_state.fx_base else None) for c in currency_options}
-
-# ============ 4) Manage Participants ============
+if "pending_writes" not in st.session_state:
+    st.session_state.pending_writes = []   # queued Sheets writes: {"range": ..., "values": [[...]]}
+if "pending_appends" not in st.session_state:
+    st.session_state.pending_appends = 0   # how many queued writes target new rows
+
+# ============ 4) Settlement (shared math lives in settlement.py) ============
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_settlement(cache_key: tuple, all_names: tuple, _df_like: pd.DataFrame) -> pd.DataFrame:
+    """Net + settlement matrix. _df_like is deliberately unhashed: cache_key
+    carries a cheap fingerprint of the data it was derived from."""
+    net = compute_net(_df_like, list(all_names))
+    return build_settlement_matrix(net, list(all_names))
+
+def settlement_section_only(df_like: pd.DataFrame, all_names: list[str], title: str, cache_tag=None):
+    st.markdown(f"**{title}**")
+    if df_like.empty:
+        st.info("No records.")
+        return
+    settle_df = cached_settlement((data_rev, cache_tag or title), tuple(all_names), df_like)
+    st.table(settle_df.round(2))
+
+# ============ 4b) Batched expense writes (one API call per flush) ============
+def queue_expense_update(sheet_row: int, row_values: list):
+    st.session_state.pending_writes.append(
+        {"range": f"A{sheet_row}:F{sheet_row}", "values": [row_values]}
+    )
+
+def queue_expense_append(row_values: list):
+    # header is row 1, so the next free row sits right after the fetched
+    # values plus any appends already waiting in the queue
+    target = len(load_sheet_data()[1]) + 1 + st.session_state.pending_appends
+    st.session_state.pending_appends += 1
+    queue_expense_update(target, row_values)
+
+def flush_pending_writes():
+    if not st.session_state.pending_writes:
+        return
+    sheet.batch_update(st.session_state.pending_writes, value_input_option="USER_ENTERED")
+    st.session_state.pending_writes = []
+    st.session_state.pending_appends = 0
+    load_sheet_data.clear()
+    cached_settlement.clear()
+
+def render_pending_writes(key: str = "flush_main"):
+    # Queued writes go out in a single batch_update round-trip; rendered in
+    # every scope that can queue, so the flush button is always reachable
+    if st.session_state.pending_writes:
+        st.info(f"📝 {len(st.session_state.pending_writes)} queued change(s) not yet written to the sheet.")
+        if st.button("Flush to Sheet", key=key):
+            flush_pending_writes()
+            st.success("✅ Queued changes written to the sheet. Please refresh to see them.")
+
+# ============ 5) Manage Participants ============
 st.subheader("🙋‍♂️ Manage Participants")
-names = participants_sheet.col_values(1)[1:]  # skip header
+names, _ = load_sheet_data()
 with st.form("add_participant", clear_on_submit=True):
     new_name = st.text_input("New participant name")
     if st.form_submit_button("Add Participant"):
         nm = new_name.strip()
         if nm and nm not in names:
             participants_sheet.append_row([nm])
+            load_sheet_data.clear()
             st.success(f"✅ Added participant: {nm}. Please refresh to see the update.")
         else:
             st.error("❌ Name is empty or already exists.")
 
-# ============ 5) Add Expense (independent currency selector) ============
+# ============ 6) Add Expense (independent currency selector) ============
 st.subheader("➕ Add Expense")
 with st.form("add_expense", clear_on_submit=True):
     date_val = st.date_input("Date", value=_date.today())
@@ -71,7 +148,7 @@ with st.form("add_expense", clear_on_submit=True):
         if not names:
             st.error("❌ No participants yet. Please add participants first.")
         else:
-            sheet.append_row([
+            queue_expense_append([
                 date_val.strftime("%Y-%m-%d"),
                 desc,
                 amt,
@@ -79,195 +156,170 @@ with st.form("add_expense", clear_on_submit=True):
                 ", ".join(participants),
                 currency_in_form
             ])
-            st.success(f"✅ Expense added in {currency_in_form}! Page will refresh to show it.")
+            st.success(f"✅ Expense added in {currency_in_form}! It is queued — flush to write it to the sheet.")
+
+render_pending_writes()
+
+# ============ 7) Read all records & show one unified table ============
+@st.cache_data(ttl=60, show_spinner=False)
+def build_expense_frames(rev: int, _values: list):
+    """Parse the raw sheet snapshot once per revision: (df_all, Arrow view)."""
+    header = _values[0] if _values else ["Date", "Description", "Amount", "Payer", "Participants", "Currency"]
+    rows = _values[1:] if len(_values) > 1 else []
 
-# ============ 6) Read all records & show one unified table ============
-values = sheet.get_all_values()
-header = values[0] if values else ["Date", "Description", "Amount", "Payer", "Participants", "Currency"]
-rows = values[1:] if len(values) > 1 else []
+    df_all = pd.DataFrame(rows, columns=header)
 
-df_all = pd.DataFrame(rows, columns=header)
+    # Backward-compat
+    if df_all.empty:
+        df_all = pd.DataFrame(columns=["Date","Description","Amount","Payer","Participants","Currency"])
 
-# Backward-compat
-if df_all.empty:
-    df_all = pd.DataFrame(columns=["Date","Description","Amount","Payer","Participants","Currency"])
+    # Attach the TRUE Google Sheet row number: first data row is row 2
+    df_all["sheet_row"] = np.arange(2, len(df_all) + 2)
 
-# Attach the TRUE Google Sheet row number: first data row is row 2
-df_all["sheet_row"] = [i + 2 for i in range(len(df_all))]
+    # Normalize types (explicit format skips pandas' date-format sniffing)
+    df_all["Amount"] = pd.to_numeric(df_all.get("Amount", 0.0), errors="coerce").fillna(0.0)
+    df_all["Date"] = pd.to_datetime(df_all["Date"], format="%Y-%m-%d", errors="coerce", cache=True)
+    df_all = split_participants(df_all)
 
-# Normalize types
-df_all["Amount"] = pd.to_numeric(df_all.get("Amount", 0.0), errors="coerce").fillna(0.0)
+    # Table view led by the real sheet row so it matches the edit selector,
+    # pre-converted to Arrow so reruns skip the pandas->Arrow serialization
+    display_cols = ["sheet_row"] + [c for c in df_all.columns if c not in ("sheet_row", "_parts", "_k")]
+    return df_all, pa.Table.from_pandas(df_all[display_cols], preserve_index=False)
+
+_, values = load_sheet_data()
+# Cheap per-rerun fingerprint of the sheet snapshot; hashed once here so
+# cache keys below stay O(1) instead of re-hashing frames per call
+data_rev = hash(tuple(map(tuple, values)))
+df_all, df_view = build_expense_frames(data_rev, values)
 
 st.subheader("📋 All Expenses (All Currencies)")
-# Show the table indexed by the real sheet row so it matches the selector below
-st.dataframe(df_all.set_index("sheet_row"), use_container_width=True)
-
-# ============ 7) Settlement helpers ============
-def _split_parts(cell):
-    return [x.strip() for x in str(cell).split(",") if x and x.strip()]
-
-def compute_net(df_like: pd.DataFrame, all_names: list[str]) -> dict:
-    """Return net dict only (Paid - Owed)."""
-    if df_like.empty or not all_names:
-        return {n: 0.0 for n in all_names}
-
-    # Paid
-    paid = {n: float(df_like.loc[df_like["Payer"] == n, "Amount"].sum()) for n in all_names}
-
-    # Share per row
-    def _share(row):
-        parts = _split_parts(row["Participants"])
-        k = len(parts) or 1
-        return float(row["Amount"]) / k
-
-    df_like = df_like.copy()
-    df_like["Share"] = df_like.apply(_share, axis=1)
-
-    # Owed
-    owed = {}
-    for n in all_names:
-        mask = df_like["Participants"].apply(lambda s: n in _split_parts(s))
-        owed[n] = float(df_like.loc[mask, "Share"].sum())
-
-    # Net
-    net = {n: paid.get(n, 0.0) - owed.get(n, 0.0) for n in all_names}
-    return net
-
-def build_settlement_matrix(net: dict, all_names: list[str]) -> pd.DataFrame:
-    """Greedy settlement from debtors to creditors; returns NxN matrix with amounts to pay."""
-    settle_df = pd.DataFrame(0.0, index=all_names, columns=all_names)
-    temp = net.copy()
-    creditors = [n for n in all_names if temp[n] > 0]
-    debtors   = [n for n in all_names if temp[n] < 0]
-    ci, di = 0, 0
-    while ci < len(creditors) and di < len(debtors):
-        c = creditors[ci]
-        d = debtors[di]
-        give = min(temp[c], -temp[d])
-        if give > 1e-9:
-            settle_df.loc[d, c] = give
-            temp[c] -= give
-            temp[d] += give
-        if temp[c] <= 1e-9: ci += 1
-        if temp[d] >= -1e-9: di += 1
-    return settle_df
-
-def settlement_section_only(df_like: pd.DataFrame, all_names: list[str], title: str):
-    st.markdown(f"**{title}**")
-    if df_like.empty:
-        st.info("No records.")
-        return
-    net = compute_net(df_like, all_names)
-    settle_df = build_settlement_matrix(net, all_names)
-    st.table(settle_df)
+st.dataframe(df_view, use_container_width=True)
 
 # ============ 8) Tabs: All Currencies -> Selected (with selector) -> Converted (FX settings inside) ============
+# Each tab body is a fragment: widget events inside one tab rerun only
+# that tab instead of the whole script.
+
+@st.fragment
+def render_all_currencies(df_all: pd.DataFrame, names: list[str]):
+    currency_groups = df_all.groupby("Currency", sort=True)
+    if currency_groups.ngroups == 0:
+        st.info("No currency data.")
+    else:
+        for c, df_c in currency_groups:
+            with st.expander(f"{c} — Settlement Matrix", expanded=True):
+                settlement_section_only(df_c, names, f"{c}")
+
+@st.fragment
+def render_selected(df_all: pd.DataFrame, names: list[str]):
+    sel = st.selectbox("Pick a currency to view", options=currency_options,
+                       index=currency_options.index(st.session_state.tab_selected_currency))
+    st.session_state.tab_selected_currency = sel
+    df_curr = df_all[df_all["Currency"] == sel].copy()
+    settlement_section_only(df_curr, names, f"🔄 {sel} — Settlement Matrix")
+
+    # Edit section (filtered by selected currency)
+    st.subheader("✏️ Edit an Expense")
+    editable = df_all[df_all["Currency"] == sel].copy()
+
+    if editable.empty:
+        st.info(f"No {sel} records to edit.")
+    else:
+        # Let people pick the actual sheet row; matches the index in the table above
+        row_to_edit = st.selectbox(
+            "Select sheet row to edit",
+            options=editable["sheet_row"].astype(int).tolist()
+        )
+        record = editable.loc[editable["sheet_row"] == row_to_edit].iloc[0]
+
+        with st.form("edit_expense", clear_on_submit=True):
+            date_e = st.date_input("Date", value=record["Date"].date())
+            desc_e = st.text_input("Description", value=record["Description"])
+            amt_e  = st.number_input("Amount", value=float(record["Amount"]), format="%.2f")
+            payer_e = st.selectbox("Payer", options=names,
+                                index=names.index(record["Payer"]) if record["Payer"] in names else 0)
+            parts_default = list(record["_parts"])
+            participants_e = st.multiselect("Participants", options=names, default=parts_default)
+            currency_e = st.selectbox("Currency", options=currency_options,
+                                    index=currency_options.index(record.get("Currency", sel)))
+
+            if st.form_submit_button("Update Expense"):
+                updated = [
+                    date_e.strftime("%Y-%m-%d"),
+                    desc_e,
+                    amt_e,
+                    payer_e,
+                    ", ".join(participants_e),
+                    currency_e
+                ]
+                queue_expense_update(int(row_to_edit), updated)
+                st.success("✅ Update queued! Flush to write it to the sheet.")
+
+    # fragment reruns skip the module-level banner, so offer the flush
+    # control here too — a queued edit must never be unreachable
+    render_pending_writes(key="flush_selected")
+
+@st.fragment
+def render_converted(df_all: pd.DataFrame, names: list[str]):
+    st.subheader("💹 FX Settings (Manual)")
+    fx_base = st.selectbox("Base currency", options=currency_options,
+                           index=currency_options.index(st.session_state.fx_base))
+    if fx_base != st.session_state.fx_base:
+        st.session_state.fx_base = fx_base
+        for c in currency_options:
+            st.session_state.fx_rates[c] = 1.0 if c == fx_base else st.session_state.fx_rates.get(c, None)
+
+    with st.form("fx_form_inside_tab"):
+        st.write(f"Set rates as: 1 unit = X {st.session_state.fx_base}")
+        rate_inputs = {}
+        for c in currency_options:
+            if c == st.session_state.fx_base:
+                st.number_input(f"{c} → {st.session_state.fx_base}", value=1.0, disabled=True, help="Base currency is always 1.0")
+                rate_inputs[c] = 1.0
+            else:
+                default_val = st.session_state.fx_rates.get(c, 0.0) or 0.0
+                rate_inputs[c] = st.number_input(f"{c} → {st.session_state.fx_base}",
+                                                 min_value=0.0, value=float(default_val),
+                                                 step=0.0001, format="%.4f")
+        if st.form_submit_button("Save FX"):
+            st.session_state.fx_rates.update(rate_inputs)
+            st.success("✅ FX rates saved.")
+
+    fx_rates = st.session_state.fx_rates.copy()
+
+    # Validate missing rates
+    missing = [c for c in df_all["Currency"].unique().tolist() if fx_rates.get(c) in (None, 0)]
+    if missing:
+        st.warning(f"⚠️ Please set FX rate(s) for: {', '.join(missing)}. 1 {missing[0]} = ? {st.session_state.fx_base}")
+
+    # Convert all expenses to base currency: int8 codes index into the
+    # rate vector, so conversion is a single SIMD multiply
+    fx_arr = fx_rate_vector(fx_rates)
+    codes = df_all["Currency"].map(currency_code).fillna(-1).astype(np.int8).to_numpy()
+    rates = np.where(codes >= 0, fx_arr[codes], np.nan)
+    # settlement only reads these three columns; no need to copy df_all
+    df_conv = pd.DataFrame({
+        "Amount": df_all["Amount"].to_numpy(dtype=np.float32) * rates,
+        "Payer": df_all["Payer"],
+        "_parts": df_all["_parts"],
+        "_k": df_all["_k"],
+    }).dropna(subset=["Amount"])
+
+    st.caption(f"All expenses converted to **{st.session_state.fx_base}** using the manual FX rates above.")
+    settlement_section_only(df_conv, names, f"🌐 Converted to {st.session_state.fx_base} — Settlement Matrix",
+                            cache_tag=("fx", st.session_state.fx_base, tuple(fx_arr.tolist())))
+
 if names:
     tabs = st.tabs([
         "All Currencies",
         "Selected",
         f"Converted (All → {st.session_state.fx_base})"
     ])
-
-    # Tab 1: All Currencies (each currency's settlement only)
     with tabs[0]:
-        unique_currencies = sorted([c for c in df_all["Currency"].dropna().unique().tolist()])
-        if not unique_currencies:
-            st.info("No currency data.")
-        else:
-            for c in unique_currencies:
-                df_c = df_all[df_all["Currency"] == c].copy()
-                with st.expander(f"{c} — Settlement Matrix", expanded=True):
-                    settlement_section_only(df_c, names, f"{c}")
-
-    # Tab 2: Selected (currency selector lives here)
+        render_all_currencies(df_all, names)
     with tabs[1]:
-        sel = st.selectbox("Pick a currency to view", options=currency_options,
-                           index=currency_options.index(st.session_state.tab_selected_currency))
-        st.session_state.tab_selected_currency = sel
-        df_curr = df_all[df_all["Currency"] == sel].copy()
-        settlement_section_only(df_curr, names, f"🔄 {sel} — Settlement Matrix")
-
-        # Edit section (filtered by selected currency)
-        st.subheader("✏️ Edit an Expense")
-        editable = df_all[df_all["Currency"] == sel].copy()
-
-        if editable.empty:
-            st.info(f"No {sel} records to edit.")
-        else:
-            # Let people pick the actual sheet row; matches the index in the table above
-            row_to_edit = st.selectbox(
-                "Select sheet row to edit",
-                options=editable["sheet_row"].astype(int).tolist()
-            )
-            record = editable.loc[editable["sheet_row"] == row_to_edit].iloc[0]
-
-            with st.form("edit_expense", clear_on_submit=True):
-                date_e = st.date_input("Date", value=pd.to_datetime(record["Date"]).date())
-                desc_e = st.text_input("Description", value=record["Description"])
-                amt_e  = st.number_input("Amount", value=float(record["Amount"]), format="%.2f")
-                payer_e = st.selectbox("Payer", options=names,
-                                    index=names.index(record["Payer"]) if record["Payer"] in names else 0)
-                parts_default = _split_parts(record["Participants"])
-                participants_e = st.multiselect("Participants", options=names, default=parts_default)
-                currency_e = st.selectbox("Currency", options=currency_options,
-                                        index=currency_options.index(record.get("Currency", sel)))
-
-                if st.form_submit_button("Update Expense"):
-                    updated = [
-                        date_e.strftime("%Y-%m-%d"),
-                        desc_e,
-                        amt_e,
-                        payer_e,
-                        ", ".join(participants_e),
-                        currency_e
-                    ]
-                    sheet.update(f"A{row_to_edit}:F{row_to_edit}", [updated])
-                    st.success("✅ Record updated! Please refresh to see changes.")
-
-    # Tab 3: Converted (FX settings inside this tab)
+        render_selected(df_all, names)
     with tabs[2]:
-        st.subheader("💹 FX Settings (Manual)")
-        fx_base = st.selectbox("Base currency", options=currency_options,
-                               index=currency_options.index(st.session_state.fx_base))
-        if fx_base != st.session_state.fx_base:
-            st.session_state.fx_base = fx_base
-            for c in currency_options:
-                st.session_state.fx_rates[c] = 1.0 if c == fx_base else st.session_state.fx_rates.get(c, None)
-
-        with st.form("fx_form_inside_tab"):
-            st.write(f"Set rates as: 1 unit = X {st.session_state.fx_base}")
-            rate_inputs = {}
-            for c in currency_options:
-                if c == st.session_state.fx_base:
-                    st.number_input(f"{c} → {st.session_state.fx_base}", value=1.0, disabled=True, help="Base currency is always 1.0")
-                    rate_inputs[c] = 1.0
-                else:
-                    default_val = st.session_state.fx_rates.get(c, 0.0) or 0.0
-                    rate_inputs[c] = st.number_input(f"{c} → {st.session_state.fx_base}",
-                                                     min_value=0.0, value=float(default_val),
-                                                     step=0.0001, format="%.4f")
-            if st.form_submit_button("Save FX"):
-                st.session_state.fx_rates.update(rate_inputs)
-                st.success("✅ FX rates saved.")
-
-        fx_rates = st.session_state.fx_rates.copy()
-
-        # Validate missing rates
-        missing = [c for c in df_all["Currency"].unique().tolist() if fx_rates.get(c) in (None, 0)]
-        if missing:
-            st.warning(f"⚠️ Please set FX rate(s) for: {', '.join(missing)}. 1 {missing[0]} = ? {st.session_state.fx_base}")
-
-        # Convert all expenses to base currency
-        df_conv = df_all.copy()
-        def _to_base(row):
-            r = fx_rates.get(row["Currency"])
-            return float(row["Amount"]) * float(r) if r not in (None, 0) else float("nan")
-        df_conv["Amount"] = df_conv.apply(_to_base, axis=1)
-        df_conv = df_conv.dropna(subset=["Amount"])
-
-        st.caption(f"All expenses converted to **{st.session_state.fx_base}** using the manual FX rates above.")
-        settlement_section_only(df_conv, names, f"🌐 Converted to {st.session_state.fx_base} — Settlement Matrix")
+        render_converted(df_all, names)
 
 else:
-    st.info("Please add participants to see settlements.")
\ No newline at end of file
+    st.info("Please add participants to see settlements.")
@@ -0,0 +1,73 @@
+"""Settlement math for the trip expense tracker.
+
+Pure pandas/NumPy — no Streamlit imports — so the single optimized
+implementation can be shared (and tested) independently of the app UI.
+Monetary math runs in float32: expense amounts are small and settlement
+only needs cent precision, so the narrower dtype halves the bytes moved
+through the indicator product (round for display).
+"""
+import numpy as np
+import pandas as pd
+
+
+def split_participants(df_like: pd.DataFrame) -> pd.DataFrame:
+    """Attach precomputed ``_parts`` (name tuples) and ``_k`` (split size)
+    columns so the Participants text is parsed exactly once per load."""
+    df_like["_parts"] = (df_like["Participants"].astype(str).str.strip()
+                         .str.split(r"\s*,\s*", regex=True)
+                         .map(lambda xs: tuple(x for x in xs if x)))
+    df_like["_k"] = df_like["_parts"].map(len).clip(lower=1)
+    return df_like
+
+def compute_net(df_like: pd.DataFrame, all_names: list[str]) -> dict:
+    """Return net dict only (Paid - Owed).
+
+    Expects the ``_parts``/``_k`` columns from :func:`split_participants`.
+    """
+    if df_like.empty or not all_names:
+        return {n: 0.0 for n in all_names}
+
+    name_idx = {n: i for i, n in enumerate(all_names)}
+
+    # R x P membership indicator from the precomputed splits: owed collapses
+    # to one matrix-vector product
+    member_codes = (df_like["_parts"].reset_index(drop=True)
+                    .explode().dropna().map(name_idx).dropna())
+    indicator = np.zeros((len(df_like), len(all_names)), dtype=np.float32)
+    indicator[member_codes.index.to_numpy(), member_codes.to_numpy(dtype=np.int64)] = 1.0
+
+    amounts = df_like["Amount"].to_numpy(dtype=np.float32)
+    shares = amounts / df_like["_k"].to_numpy(dtype=np.float32)
+    owed = shares @ indicator
+
+    payer_codes = df_like["Payer"].map(name_idx).fillna(-1).astype(int).to_numpy()
+    known = payer_codes >= 0
+    paid = np.bincount(payer_codes[known], weights=amounts[known],
+                       minlength=len(all_names)).astype(np.float32)
+
+    return dict(zip(all_names, paid - owed))
+
+def build_settlement_matrix(net: dict, all_names: list[str]) -> pd.DataFrame:
+    """Greedy settlement from debtors to creditors; returns NxN matrix with amounts to pay."""
+    n = len(all_names)
+    matrix = np.zeros((n, n), dtype=np.float32)
+    balances = np.array([net.get(nm, 0.0) for nm in all_names], dtype=np.float32)
+
+    # Largest balances first, then walk both lists with two pointers
+    creditors = np.where(balances > 0)[0]
+    debtors   = np.where(balances < 0)[0]
+    creditors = creditors[np.argsort(-balances[creditors])]
+    debtors   = debtors[np.argsort(balances[debtors])]
+    credit = balances[creditors]
+    debt   = -balances[debtors]
+
+    ci, di = 0, 0
+    while ci < len(creditors) and di < len(debtors):
+        give = min(credit[ci], debt[di])
+        if give > 1e-6:
+            matrix[debtors[di], creditors[ci]] = give
+            credit[ci] -= give
+            debt[di]   -= give
+        if credit[ci] <= 1e-6: ci += 1
+        if debt[di]   <= 1e-6: di += 1
+    return pd.DataFrame(matrix, index=all_names, columns=all_names)